@@ -4,19 +4,47 @@
 # SPDX-License-Identifier: BSD 2-Clause License
 #
 
+import asyncio
+import audioop
+import base64
+import copy
+import functools
 import os
+import re
 import sys
+from collections import OrderedDict
+from dataclasses import dataclass
 
+import numpy as np
+import orjson
 from dotenv import load_dotenv
 from loguru import logger
-from pipecat.audio.vad.silero import SileroVADAnalyzer
+from pipecat.audio.utils import pcm_to_ulaw, ulaw_to_pcm
+from pipecat.audio.vad.silero import SileroOnnxModel, SileroVADAnalyzer
+from pipecat.audio.vad.vad_analyzer import VADAnalyzer
+from pipecat.frames.frames import (
+    AudioRawFrame,
+    DataFrame,
+    Frame,
+    InputAudioRawFrame,
+    LLMFullResponseEndFrame,
+    LLMFullResponseStartFrame,
+    LLMTextFrame,
+    StartInterruptionFrame,
+    TranscriptionFrame,
+)
 from pipecat.pipeline.pipeline import Pipeline
 from pipecat.pipeline.runner import PipelineRunner
 from pipecat.pipeline.task import PipelineParams, PipelineTask
-from pipecat.processors.aggregators.openai_llm_context import OpenAILLMContext
+from pipecat.processors.aggregators.openai_llm_context import (
+    OpenAILLMContext,
+    OpenAILLMContextFrame,
+)
+from pipecat.processors.frame_processor import FrameDirection, FrameProcessor
 from pipecat.runner.types import RunnerArguments
-from pipecat.runner.utils import parse_telephony_websocket
 from pipecat.serializers.twilio import TwilioFrameSerializer
+from pipecat.services.azure.tts import AzureTTSService
+
 # from pipecat.services.cartesia.tts import CartesiaTTSService
 from pipecat.services.deepgram.stt import DeepgramSTTService
 from pipecat.services.openai.llm import OpenAILLMService
@@ -25,16 +53,305 @@ from pipecat.transports.websocket.fastapi import (
     FastAPIWebsocketParams,
     FastAPIWebsocketTransport,
 )
-from pipecat.services.azure.tts import AzureTTSService
 
 load_dotenv(override=True)
 
 logger.remove(0)
-logger.add(sys.stderr, level="DEBUG")
+# DEBUG logging formats every pipecat frame-level message; production runs at INFO.
+logger.add(sys.stderr, level=os.getenv("LOG_LEVEL", "INFO"))
+
+try:
+    from ten_vad import TenVad
+except ModuleNotFoundError:
+    TenVad = None
+
+# TEN VAD runs on 16 kHz audio in 256-sample (16ms) hops.
+TEN_VAD_SAMPLE_RATE = 16000
+TEN_VAD_HOP_SIZE = 256
+
+
+class TenVADAnalyzer(VADAnalyzer):
+    """VAD analyzer backed by TEN VAD, which detects end of speech faster than Silero."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._model = TenVad(hop_size=TEN_VAD_HOP_SIZE)
+        self._ratecv_state = None
+
+    def set_sample_rate(self, sample_rate: int):
+        if sample_rate != 16000 and sample_rate != 8000:
+            raise ValueError(
+                f"TEN VAD sample rate needs to be 16000 or 8000 (sample rate: {sample_rate})"
+            )
+        super().set_sample_rate(sample_rate)
+
+    def num_frames_required(self) -> int:
+        # One 16ms hop at the input rate: 256 frames at 16 kHz, 128 at 8 kHz.
+        return TEN_VAD_HOP_SIZE * self.sample_rate // TEN_VAD_SAMPLE_RATE
+
+    def voice_confidence(self, buffer) -> float:
+        try:
+            if self.sample_rate != TEN_VAD_SAMPLE_RATE:
+                # Telephony audio is 8 kHz; upsample only the frame handed to the model.
+                buffer, self._ratecv_state = audioop.ratecv(
+                    buffer, 2, 1, self.sample_rate, TEN_VAD_SAMPLE_RATE, self._ratecv_state
+                )
+            audio = np.frombuffer(buffer, dtype=np.int16)
+            if len(audio) != TEN_VAD_HOP_SIZE:
+                # The resampler can be off by a sample; pad or trim to one hop.
+                audio = np.resize(audio, TEN_VAD_HOP_SIZE)
+            probability, _ = self._model.process(audio)
+            return probability
+        except Exception as e:
+            logger.error(f"Error analyzing audio with TEN VAD: {e}")
+            return 0
+
+
+@functools.cache
+def silero_model() -> SileroOnnxModel:
+    """Load the Silero ONNX model once per process."""
+    return SileroVADAnalyzer()._model
+
+
+class SharedSileroVADAnalyzer(SileroVADAnalyzer):
+    """Silero VAD that reuses the process-wide ONNX session instead of loading it per call."""
+
+    def __init__(self, **kwargs):
+        # Skip SileroVADAnalyzer.__init__, which would load the model from disk again.
+        VADAnalyzer.__init__(self, **kwargs)
+        # The inference session is shared; the recurrent state is per call.
+        self._model = copy.copy(silero_model())
+        self._model.reset_states()
+        self._last_reset_time = 0
+
+
+@functools.cache
+def ten_vad_available() -> bool:
+    """Check once per process whether TEN VAD's native library loads on this platform."""
+    if TenVad is None:
+        return False
+    try:
+        TenVad(hop_size=TEN_VAD_HOP_SIZE)
+    except (OSError, NotImplementedError) as e:
+        logger.warning(f"TEN VAD unavailable, falling back to Silero: {e}")
+        return False
+    return True
+
+
+def create_vad_analyzer() -> VADAnalyzer:
+    """Use TEN VAD when it is installed for this platform, otherwise Silero."""
+    if ten_vad_available():
+        return TenVADAnalyzer()
+    return SharedSileroVADAnalyzer()
+
+
+def warmup():
+    """Load the VAD model now so the first call does not pay for it."""
+    create_vad_analyzer()
+
+
+_openai_client = None
+
+
+class SharedClientOpenAILLMService(OpenAILLMService):
+    """OpenAI LLM service that reuses one client, and its warm connection pool, across calls."""
+
+    def create_client(self, **kwargs):
+        global _openai_client
+        if _openai_client is None:
+            _openai_client = super().create_client(**kwargs)
+        return _openai_client
+
+
+_NON_WORD_RE = re.compile(r"[^\w\s']")
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase and strip punctuation; transcripts vary in both but mean the same."""
+    return " ".join(_NON_WORD_RE.sub(" ", text.lower()).split())
+
+
+class OrjsonTwilioFrameSerializer(TwilioFrameSerializer):
+    """Twilio serializer that encodes and decodes media messages with orjson.
+
+    Twilio exchanges a JSON media message every 20ms in each direction, so the stdlib
+    json parse/dump is the serializer's main per-frame cost. Other events are rare and
+    go through the stock implementation.
+    """
+
+    async def serialize(self, frame: Frame) -> str | bytes | None:
+        if not isinstance(frame, AudioRawFrame):
+            return await super().serialize(frame)
+
+        # Output: Convert PCM at frame's rate to 8kHz μ-law for Twilio
+        serialized_data = await pcm_to_ulaw(
+            frame.audio, frame.sample_rate, self._twilio_sample_rate, self._output_resampler
+        )
+        if not serialized_data:
+            return None
+
+        payload = base64.b64encode(serialized_data).decode("utf-8")
+        answer = {"event": "media", "streamSid": self._stream_sid, "media": {"payload": payload}}
+        return orjson.dumps(answer).decode("utf-8")
+
+    async def deserialize(self, data: str | bytes) -> Frame | None:
+        message = orjson.loads(data)
+        if message["event"] != "media":
+            return await super().deserialize(data)
+
+        # Input: Convert Twilio's 8kHz μ-law to PCM at pipeline input rate
+        payload = base64.b64decode(message["media"]["payload"])
+        deserialized_data = await ulaw_to_pcm(
+            payload, self._twilio_sample_rate, self._sample_rate, self._input_resampler
+        )
+        if not deserialized_data:
+            return None
+
+        return InputAudioRawFrame(
+            audio=deserialized_data, num_channels=1, sample_rate=self._sample_rate
+        )
+
+
+# Only hesitation sounds: "mhm" or "hmm" can be a caller's whole answer on a phone call.
+FILLER_WORDS = {"ah", "er", "uh", "um"}
+
+
+class TranscriptionFilter(FrameProcessor):
+    """Drops transcripts with nothing to answer, so noise never costs an LLM + TTS turn."""
+
+    async def process_frame(self, frame: Frame, direction: FrameDirection):
+        await super().process_frame(frame, direction)
+
+        if isinstance(frame, TranscriptionFrame):
+            words = normalize_text(frame.text).split()
+            if all(word in FILLER_WORDS for word in words):
+                logger.debug(f"Dropping empty or filler-only transcript: {frame.text!r}")
+                return
+
+        await self.push_frame(frame, direction)
+
+
+class ResponseCache:
+    """Process-wide cache of LLM replies for the opening turns of a call.
+
+    Outbound calls tend to open the same way ("hello?", "who is this?"), so a reply
+    generated for one conversation prefix is replayed when another call reaches the
+    same prefix, skipping the LLM round-trip. Only short conversations are cached.
+    """
+
+    def __init__(self, *, max_turns: int = 4, max_size: int = 1024):
+        self._max_turns = max_turns
+        self._max_size = max_size
+        self._responses = OrderedDict()
+
+    def key_for(self, messages: list) -> tuple | None:
+        """Build a cache key from the whole conversation, or None if it isn't cacheable."""
+        turns = [m for m in messages if m.get("role") != "system"]
+        if not turns or len(turns) > self._max_turns or turns[-1].get("role") != "user":
+            return None
+        key = []
+        for message in messages:
+            role, content = message.get("role"), message.get("content")
+            if role not in ("system", "user", "assistant") or not isinstance(content, str):
+                return None
+            key.append((role, normalize_text(content)))
+        return tuple(key)
+
+    def get(self, key: tuple) -> str | None:
+        response = self._responses.get(key)
+        if response is not None:
+            self._responses.move_to_end(key)
+        return response
+
+    def put(self, key: tuple, response: str):
+        self._responses[key] = response
+        self._responses.move_to_end(key)
+        while len(self._responses) > self._max_size:
+            self._responses.popitem(last=False)
+
+
+RESPONSE_CACHE = ResponseCache()
+
+
+@dataclass
+class ResponseCacheKeyFrame(DataFrame):
+    """Carries the cache key of a context sent to the LLM, ahead of that context."""
+
+    key: tuple
 
 
-async def run_bot(transport: BaseTransport, handle_sigint: bool):
-    llm = OpenAILLMService(api_key=os.getenv("OPENAI_API_KEY"))
+class ResponseCacheLookup(FrameProcessor):
+    """Answers a context from the response cache instead of forwarding it to the LLM."""
+
+    def __init__(self, cache: ResponseCache, **kwargs):
+        super().__init__(**kwargs)
+        self._cache = cache
+
+    async def process_frame(self, frame: Frame, direction: FrameDirection):
+        await super().process_frame(frame, direction)
+
+        if isinstance(frame, OpenAILLMContextFrame):
+            key = self._cache.key_for(frame.context.get_messages())
+            response = self._cache.get(key) if key else None
+            if response is not None:
+                logger.debug(f"Response cache hit: {response}")
+                await self.push_frame(LLMFullResponseStartFrame())
+                await self.push_frame(LLMTextFrame(response))
+                await self.push_frame(LLMFullResponseEndFrame())
+                return
+            if key:
+                # The LLM passes this through, so the recorder sees it before the reply.
+                await self.push_frame(ResponseCacheKeyFrame(key))
+
+        await self.push_frame(frame, direction)
+
+
+class ResponseCacheRecorder(FrameProcessor):
+    """Stores complete LLM replies under the key the lookup sent ahead of their context."""
+
+    def __init__(self, cache: ResponseCache, **kwargs):
+        super().__init__(**kwargs)
+        self._cache = cache
+        self._pending_key = None
+        self._key = None
+        self._text = []
+
+    async def process_frame(self, frame: Frame, direction: FrameDirection):
+        await super().process_frame(frame, direction)
+
+        if isinstance(frame, ResponseCacheKeyFrame):
+            self._pending_key = frame.key
+            return
+        elif isinstance(frame, LLMFullResponseStartFrame):
+            # Cache hits arrive without a key frame, so they are never stored again.
+            self._key, self._pending_key = self._pending_key, None
+            self._text = []
+        elif isinstance(frame, LLMTextFrame) and self._key:
+            self._text.append(frame.text)
+        elif isinstance(frame, LLMFullResponseEndFrame) and self._key:
+            if self._text:
+                self._cache.put(self._key, "".join(self._text))
+            self._key = None
+        elif isinstance(frame, StartInterruptionFrame):
+            # A reply cut off by the caller is incomplete, and a context dropped before
+            # the LLM answered it leaves a key with no reply; never cache either.
+            self._pending_key = None
+            self._key = None
+
+        await self.push_frame(frame, direction)
+
+
+async def run_bot(transport: BaseTransport, call_id: str, handle_sigint: bool):
+    # The context below is append-only (system prompt, then alternating turns), so each
+    # request shares the previous one's prefix. Keying the cache by call keeps every
+    # turn of this conversation on OpenAI's prompt cache for that prefix. It goes in
+    # extra_body because only recent openai SDKs accept prompt_cache_key as a keyword.
+    llm = SharedClientOpenAILLMService(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        params=OpenAILLMService.InputParams(
+            extra={"extra_body": {"prompt_cache_key": call_id}}
+        ),
+    )
 
     stt = DeepgramSTTService(api_key=os.getenv("DEEPGRAM_API_KEY"))
 
@@ -47,7 +364,10 @@ async def run_bot(transport: BaseTransport, handle_sigint: bool):
         api_key=os.getenv("AZURE_SPEECH_API_KEY"),
         region=os.getenv("AZURE_SPEECH_REGION", "eastus"),
         voice="en-US-JennyNeural",
-        language="en-US"
+        language="en-US",
+        # audio_out_sample_rate already makes Azure synthesize at 8kHz; pinning it here
+        # keeps TTS at the telephony rate if the pipeline's output rate ever changes.
+        sample_rate=8000,
     )
 
     messages = [
@@ -64,12 +384,18 @@ async def run_bot(transport: BaseTransport, handle_sigint: bool):
     context = OpenAILLMContext(messages)
     context_aggregator = llm.create_context_aggregator(context)
 
+    response_cache_lookup = ResponseCacheLookup(RESPONSE_CACHE)
+    response_cache_recorder = ResponseCacheRecorder(RESPONSE_CACHE)
+
     pipeline = Pipeline(
         [
             transport.input(),  # Websocket input from client
             stt,  # Speech-To-Text
+            TranscriptionFilter(),  # Drops empty and filler-only transcripts
             context_aggregator.user(),
+            response_cache_lookup,  # Replays cached replies for repeated openings
             llm,  # LLM
+            response_cache_recorder,
             tts,  # Text-To-Speech
             transport.output(),  # Websocket output to client
             context_aggregator.assistant(),
@@ -101,39 +427,41 @@ async def run_bot(transport: BaseTransport, handle_sigint: bool):
     await runner.run(task)
 
 
+async def wait_for_twilio_start(websocket) -> dict:
+    """Read Twilio Media Stream events until `start` and return its call data."""
+    # Twilio sends `connected` and `start` back to back, so awaiting each message
+    # as it arrives is enough; the caller bounds the whole handshake with one timeout.
+    async for message in websocket.iter_text():
+        data = orjson.loads(message)
+        if data.get("event") == "start":
+            start = data["start"]
+            return {"stream_id": start["streamSid"], "call_id": start["callSid"]}
+    raise ConnectionError("WebSocket closed before the Twilio start event")
+
+
 async def bot(runner_args: RunnerArguments):
     """Main bot entry point compatible with Pipecat Cloud."""
     
-    print("Bot function started, waiting for Twilio data...")
-    
+    logger.debug("Bot function started, waiting for Twilio data...")
+
     try:
-        # Add timeout and better error handling
-        import asyncio
-        
-        print("Calling parse_telephony_websocket...")
-        transport_type, call_data = await asyncio.wait_for(
-            parse_telephony_websocket(runner_args.websocket),
+        call_data = await asyncio.wait_for(
+            wait_for_twilio_start(runner_args.websocket),
             timeout=30.0  # 30 second timeout
         )
-        logger.info(f"Auto-detected transport: {transport_type}")
         logger.info(f"Call data: {call_data}")
         
     except asyncio.TimeoutError:
         logger.error("Timeout waiting for Twilio Media Stream data")
         return
-    except StopAsyncIteration:
+    except ConnectionError:
         logger.error("No data received from WebSocket - expecting Twilio Media Stream")
         return
-    except Exception as e:
-        logger.error(f"Error parsing telephony WebSocket: {e}")
-        import traceback
-        logger.error(f"Full traceback: {traceback.format_exc()}")
+    except Exception:
+        logger.exception("Error parsing telephony WebSocket")
         return
 
-    # Rest of your bot function...
-    print("Successfully parsed Twilio data, continuing with bot setup...")
-    
-    serializer = TwilioFrameSerializer(
+    serializer = OrjsonTwilioFrameSerializer(
         stream_sid=call_data["stream_id"],
         call_sid=call_data["call_id"],
         account_sid=os.getenv("TWILIO_ACCOUNT_SID", ""),
@@ -146,11 +474,14 @@ async def bot(runner_args: RunnerArguments):
             audio_in_enabled=True,
             audio_out_enabled=True,
             add_wav_header=False,
-            vad_analyzer=SileroVADAnalyzer(),
+            # Send 20ms chunks (one Twilio media frame) instead of the default 40ms,
+            # so the first TTS audio reaches the caller without waiting on a bigger buffer.
+            audio_out_10ms_chunks=2,
+            vad_analyzer=create_vad_analyzer(),
             serializer=serializer,
         ),
     )
 
     handle_sigint = runner_args.handle_sigint
 
-    await run_bot(transport, handle_sigint)
\ No newline at end of file
+    await run_bot(transport, call_data["call_id"], handle_sigint)
\ No newline at end of file
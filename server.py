@@ -1,191 +1,369 @@
 """server.py - Local Development Version"""
 
+import functools
 import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qsl
+from xml.sax.saxutils import escape
+
+import orjson
+import redis.asyncio as redis
 import uvicorn
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, Request, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import ORJSONResponse, Response
+from loguru import logger
+from pipecat.runner.types import WebSocketRunnerArguments
+from pydantic import BaseModel, ConfigDict, Field
+from redis.exceptions import RedisError
+from twilio.http.async_http_client import AsyncTwilioHttpClient
 from twilio.rest import Client as TwilioClient
-from twilio.twiml.voice_response import Connect, Stream, VoiceResponse
+
+from bot import bot, warmup
 
 load_dotenv(override=True)
 
-# In-memory store for body data by call SID
-call_body_data = {}
+# Configuration only changes on restart, so read it once instead of per request.
+TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
+TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
+TWILIO_PHONE_NUMBER = os.getenv("TWILIO_PHONE_NUMBER")
+BASE_URL = os.getenv("BASE_URL")
+NGROK_URL = os.getenv("NGROK_URL")
+ALLOW_ORIGINS = [
+    origin.strip() for origin in os.getenv("ALLOW_ORIGINS", "").split(",") if origin.strip()
+]
+
+class TTLDict:
+    """Dict whose entries expire `ttl` seconds after they were set, holding at most `maxsize`."""
+
+    def __init__(self, ttl: float, maxsize: int):
+        self._ttl = ttl
+        self._maxsize = maxsize
+        # Every entry gets the same TTL, so insertion order is also expiry order.
+        self._data = OrderedDict()
+
+    def _evict_expired(self, now: float):
+        while self._data:
+            key, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            del self._data[key]
+
+    def __setitem__(self, key, value):
+        now = time.monotonic()
+        self._evict_expired(now)
+        self._data.pop(key, None)
+        self._data[key] = (now + self._ttl, value)
+        # Past the cap, drop the oldest entries, which would have expired first anyway
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        if item is None or item[0] <= time.monotonic():
+            return default
+        return item[1]
+
+# In-memory store for body data by call SID. Entries whose /twiml callback never
+# arrives (failed or unanswered calls) expire instead of accumulating forever.
+CALL_BODY_TTL_SECS = 300
+CALL_BODY_MAX_ENTRIES = 10_000
+call_body_data = TTLDict(ttl=CALL_BODY_TTL_SECS, maxsize=CALL_BODY_MAX_ENTRIES)
+
+# With more than one worker process, /start and /twiml for the same call can land
+# on different workers, so the store has to live in Redis instead.
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = redis.from_url(REDIS_URL) if REDIS_URL else None
+
+async def save_call_body(call_sid: str, body_data: dict):
+    """Keep the /start body until Twilio fetches TwiML for the call."""
+    if redis_client:
+        await redis_client.set(
+            f"call_body:{call_sid}", orjson.dumps(body_data), ex=CALL_BODY_TTL_SECS
+        )
+    else:
+        call_body_data[call_sid] = body_data
 
-def generate_twiml(host: str, body_data: dict = None) -> str:
-    """Generate TwiML response with WebSocket streaming using Twilio SDK."""
-    
+async def take_call_body(call_sid: str) -> dict:
+    """Return and forget the /start body saved for the call, if any."""
+    if not call_sid:
+        return {}
+
+    if redis_client:
+        raw = await redis_client.getdel(f"call_body:{call_sid}")
+        return orjson.loads(raw) if raw else {}
+
+    return call_body_data.pop(call_sid, {})
+
+# TwiML has a fixed shape; only the stream URL and its parameters vary per call.
+TWIML_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<Response><Connect>{stream}</Connect><Pause length="20" /></Response>'
+)
+# Same escaping as ElementTree, which Twilio's TwiML builder serializes with
+XML_ATTR_ENTITIES = {'"': "&quot;", "\n": "&#10;", "\r": "&#13;", "\t": "&#09;"}
+
+def xml_attr(name: str, value) -> str:
+    """Render an attribute like Twilio's TwiML builder: None omits it, bools are lowercase."""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        value = str(value).lower()
+    return f' {name}="{escape(str(value), XML_ATTR_ENTITIES)}"'
+
+def websocket_base_url() -> str | None:
+    """Resolve the public WebSocket base URL from BASE_URL or NGROK_URL."""
     # Check if we're in production
-    base_url = os.getenv("BASE_URL")
-    if base_url:
+    if BASE_URL:
         # Production - use BASE_URL and force HTTPS/WSS
-        if base_url.startswith("http://"):
-            websocket_url = base_url.replace("http://", "wss://") + "/ws"
-        else:
-            websocket_url = base_url.replace("https://", "wss://") + "/ws"
-    else:
-        # Local - use ngrok URL
-        ngrok_url = os.getenv("NGROK_URL")
-        if ngrok_url:
-            websocket_url = ngrok_url.replace("https://", "wss://").replace("http://", "ws://") + "/ws"
-        else:
-            # Force WSS even for IP
-            websocket_url = f"wss://{host}/ws"
-    
-    print(f"DEBUG - WebSocket URL: {websocket_url}")
-    
-    response = VoiceResponse()
-    connect = Connect()
-    stream = Stream(url=websocket_url)
+        if BASE_URL.startswith("http://"):
+            return BASE_URL.replace("http://", "wss://")
+        return BASE_URL.replace("https://", "wss://")
 
-    if body_data:
-        for key, value in body_data.items():
-            stream.parameter(name=key, value=value)
+    # Local - use ngrok URL
+    if NGROK_URL:
+        return NGROK_URL.replace("https://", "wss://").replace("http://", "ws://")
+    return None
 
-    connect.append(stream)
-    response.append(connect)
-    response.pause(length=20)
-    
-    return str(response)
+WEBSOCKET_BASE_URL = websocket_base_url()
+WEBSOCKET_URL = f"{WEBSOCKET_BASE_URL}/ws" if WEBSOCKET_BASE_URL else None
+# Escaped once, since it goes into every TwiML response unchanged
+WEBSOCKET_URL_ATTR = escape(WEBSOCKET_URL, XML_ATTR_ENTITIES) if WEBSOCKET_URL else None
 
-def make_twilio_call(to_number: str, from_number: str, twiml_url: str):
-    """Make an outbound call using Twilio's REST API."""
-    account_sid = os.getenv("TWILIO_ACCOUNT_SID")
-    auth_token = os.getenv("TWILIO_AUTH_TOKEN")
+# Production uses BASE_URL, local development the ngrok tunnel
+PUBLIC_URL = BASE_URL or NGROK_URL
+TWIML_URL = f"{PUBLIC_URL}/twiml" if PUBLIC_URL else None
 
-    if not account_sid or not auth_token:
+def generate_twiml(host: str, body_data: dict = None) -> str:
+    """Generate TwiML response with WebSocket streaming."""
+    # Force WSS even for IP
+    websocket_url = WEBSOCKET_URL or f"wss://{host}/ws"
+
+    logger.debug(f"WebSocket URL: {websocket_url}")
+
+    url = WEBSOCKET_URL_ATTR or escape(websocket_url, XML_ATTR_ENTITIES)
+    if body_data:
+        parameters = "".join(
+            f"<Parameter{xml_attr('name', key)}{xml_attr('value', value)} />"
+            for key, value in body_data.items()
+        )
+        stream = f'<Stream url="{url}">{parameters}</Stream>'
+    else:
+        stream = f'<Stream url="{url}" />'
+
+    return TWIML_TEMPLATE.format(stream=stream)
+
+@functools.lru_cache(maxsize=128)
+def encoded_twiml(host: str) -> bytes:
+    """TwiML for calls without body data, which only varies by host, encoded once."""
+    return generate_twiml(host).encode()
+
+_twilio_client = None
+
+def twilio_client() -> TwilioClient:
+    """Return the process-wide Twilio client, keeping its connection to api.twilio.com warm."""
+    global _twilio_client
+    if _twilio_client is None:
+        # Created on first use so the aiohttp session belongs to the running event loop.
+        # The async HTTP client keeps API round-trips from blocking that loop, which also
+        # serves every live media stream on this worker.
+        _twilio_client = TwilioClient(
+            TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, http_client=AsyncTwilioHttpClient()
+        )
+    return _twilio_client
+
+async def make_twilio_call(to_number: str, from_number: str, twiml_url: str):
+    """Make an outbound call using Twilio's REST API."""
+    if not TWILIO_ACCOUNT_SID or not TWILIO_AUTH_TOKEN:
         raise ValueError("Missing Twilio credentials")
 
-    client = TwilioClient(account_sid, auth_token)
-    call = client.calls.create(to=to_number, from_=from_number, url=twiml_url, method="POST")
+    call = await twilio_client().calls.create_async(
+        to=to_number, from_=from_number, url=twiml_url, method="POST"
+    )
     return {"sid": call.sid}
 
-app = FastAPI()
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+class StartRequest(BaseModel):
+    """Body of a /start request."""
+
+    # Accept numbers as well as strings, as the old str(data["phone_number"]) did
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+
+    phone_number: str = Field(min_length=1)
+    body: dict | None = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load models and open clients before the first call, close them on shutdown."""
+    warmup()
+    if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN:
+        twilio_client()
+
+    yield
+
+    if _twilio_client is not None:
+        await _twilio_client.http_client.close()
+    if redis_client:
+        await redis_client.aclose()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Only browser front ends need CORS; Twilio's webhooks and media streams send no Origin.
+if ALLOW_ORIGINS:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=ALLOW_ORIGINS,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+# The health payload never changes, so build the finished response once
+HEALTH_RESPONSE = Response(
+    content=orjson.dumps({"status": "healthy", "config_method": "url_encoded"}),
+    media_type="application/json",
 )
 
 @app.get("/health")
-async def health():
-    return {
-        "status": "healthy",
-        "config_method": "url_encoded"
-    }
+async def health() -> Response:
+    return HEALTH_RESPONSE
 
 @app.post("/start")
-async def initiate_outbound_call(request: Request) -> JSONResponse:
+async def initiate_outbound_call(start: StartRequest) -> ORJSONResponse:
     """Handle outbound call request and initiate call via Twilio."""
-    print("Received outbound call request")
+    logger.info("Received outbound call request")
 
     try:
-        data = await request.json()
-        if not data.get("phone_number"):
-            raise HTTPException(status_code=400, detail="Missing 'phone_number' in the request body")
-
-        phone_number = str(data["phone_number"])
-        body_data = data.get("body", {})
-
-        # Check if we're in production
-        base_url = os.getenv("BASE_URL")
-        if base_url:
-            # Production
-            twiml_url = f"{base_url}/twiml"
-        else:
-            # Local
-            ngrok_url = os.getenv("NGROK_URL")
-            if not ngrok_url:
-                raise HTTPException(status_code=500, detail="NGROK_URL not set")
-            twiml_url = f"{ngrok_url}/twiml"
+        # FastAPI has already parsed and validated the body, rejecting it with a 422
+        # when phone_number is missing or empty.
+        phone_number = start.phone_number
+        body_data = start.body
+
+        if not TWIML_URL:
+            raise HTTPException(status_code=500, detail="NGROK_URL not set")
 
-        call_result = make_twilio_call(
+        call_result = await make_twilio_call(
             to_number=phone_number,
-            from_number=os.getenv("TWILIO_PHONE_NUMBER"),
-            twiml_url=twiml_url,
+            from_number=TWILIO_PHONE_NUMBER,
+            twiml_url=TWIML_URL,
         )
         call_sid = call_result["sid"]
 
         if body_data:
-            call_body_data[call_sid] = body_data
-
-        return JSONResponse(
+            try:
+                await save_call_body(call_sid, body_data)
+            except RedisError:
+                # The call is already placed; failing here would invite a retry and
+                # a duplicate call, so it goes ahead without its parameters.
+                logger.exception(f"Failed to store body data for call {call_sid}")
+
+        return ORJSONResponse(
             {"call_sid": call_sid, "status": "call_initiated", "phone_number": phone_number}
         )
 
     except Exception as e:
-        print(f"Error: {e}")
+        logger.error(f"Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/twiml")
-async def get_twiml(request: Request) -> HTMLResponse:
+async def get_twiml(request: Request) -> Response:
     """Return TwiML instructions for connecting call to WebSocket."""
-    print("Serving TwiML for outbound call")
+    logger.info("Serving TwiML for outbound call")
 
-    form_data = await request.form()
+    # Twilio posts a small urlencoded form; parsing it directly skips Starlette's
+    # multipart-capable form machinery.
+    form_data = None
+    if request.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+        try:
+            form_data = dict(parse_qsl((await request.body()).decode(), max_num_fields=64))
+        except ValueError:
+            # Too many fields or not UTF-8 (UnicodeDecodeError is a ValueError): not a
+            # typical Twilio body, so let Starlette's more lenient parser handle it.
+            form_data = None
+    if form_data is None:
+        form_data = await request.form()
     call_sid = form_data.get("CallSid", "")
 
-    body_data = call_body_data.get(call_sid, {})
-
-    if call_sid and call_sid in call_body_data:
-        del call_body_data[call_sid]
+    try:
+        body_data = await take_call_body(call_sid)
+    except RedisError:
+        # Same as in /start: connect the call without its parameters rather than
+        # have Twilio play an application error and hang up.
+        logger.exception(f"Failed to load body data for call {call_sid}")
+        body_data = {}
 
     try:
         host = request.headers.get("host")
         if not host:
             raise HTTPException(status_code=400, detail="Unable to determine server host")
 
-        twiml_content = generate_twiml(host, body_data)
-        return HTMLResponse(content=twiml_content, media_type="application/xml")
+        if body_data:
+            twiml_content = generate_twiml(host, body_data).encode()
+        else:
+            twiml_content = encoded_twiml(host)
+        return Response(content=twiml_content, media_type="application/xml")
 
     except Exception as e:
-        print(f"Error generating TwiML: {e}")
+        logger.error(f"Error generating TwiML: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to generate TwiML: {str(e)}")
 
-@app.websocket("/ws")
+# A plain Starlette route: the handler takes no dependencies, so skip FastAPI's
+# per-connection dependency solving on the media stream connect path
+@app.websocket_route("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """Handle WebSocket connection from Twilio Media Streams."""
     try:
+        # Twilio media frames are small 20ms writes, so Nagle must stay off on this
+        # socket. asyncio and uvloop both set TCP_NODELAY on every accepted TCP
+        # connection, and ASGI does not expose the raw socket, so nothing to do here.
+        # Dead peers are caught by the WebSocket pings configured in uvicorn.run.
         await websocket.accept()
-        print("WebSocket connection accepted for outbound call")
-        print(f"WebSocket headers: {dict(websocket.headers)}")
-        print(f"WebSocket query params: {dict(websocket.query_params)}")
-        
-        # Wait a moment to see if we receive any initial data
-        import asyncio
-        print("Waiting for initial WebSocket data...")
-        
-        try:
-            # Try to receive the first message with a timeout
-            message = await asyncio.wait_for(websocket.receive(), timeout=5.0)
-            print(f"Received first WebSocket message: {message}")
-        except asyncio.TimeoutError:
-            print("No initial message received within 5 seconds")
-        except Exception as e:
-            print(f"Error receiving initial message: {e}")
-
-        from bot import bot
-        from pipecat.runner.types import WebSocketRunnerArguments
+        logger.info("WebSocket connection accepted for outbound call")
+        # Lazy so the dict copies are only made when debug logging is on
+        logger.opt(lazy=True).debug("WebSocket headers: {}", lambda: dict(websocket.headers))
+        logger.opt(lazy=True).debug(
+            "WebSocket query params: {}", lambda: dict(websocket.query_params)
+        )
 
+        # Hand the stream over untouched: bot() reads the Twilio handshake itself.
         runner_args = WebSocketRunnerArguments(websocket=websocket)
         runner_args.handle_sigint = False
 
-        print("About to call bot() function...")
+        logger.debug("About to call bot() function...")
         await bot(runner_args)
 
-    except Exception as e:
-        print(f"Error in WebSocket endpoint: {e}")
-        import traceback
-        print(f"Full traceback: {traceback.format_exc()}")
+    except Exception:
+        logger.exception("Error in WebSocket endpoint")
     finally:
-        print("WebSocket connection handler completed")
+        logger.info("WebSocket connection handler completed")
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "800"))
-    print(f"Starting Twilio outbound chatbot server on port {port}")
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    logger.info(f"Starting Twilio outbound chatbot server on port {port}")
+    # Workers only share call bodies through Redis, so fan out across cores only then.
+    workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) if REDIS_URL else 1))
+    uvicorn.run(
+        "server:app",
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        # libuv event loop and C HTTP parser instead of asyncio's selector loop and h11
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+        # Ping media streams every 10s and drop them if no pong within 10s, so a
+        # half-open Twilio connection ends its call in seconds, not after the OS's
+        # two-hour TCP keepalive
+        ws_ping_interval=10.0,
+        ws_ping_timeout=10.0,
+        # Twilio media messages are a few hundred bytes; the 16 MiB default only
+        # lets a misbehaving peer make us buffer far more than a call ever needs
+        ws_max_size=64 * 1024,
+        # Shed load with a 503 instead of running out of file descriptors; each live
+        # call holds one connection for its whole duration
+        limit_concurrency=int(os.getenv("MAX_CONCURRENCY", "500")),
+        # Room for bursts of Twilio webhooks and media stream connects
+        backlog=2048,
+    )
\ No newline at end of file